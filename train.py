@@ -35,6 +35,12 @@ parser.add_argument('--expr_name', type=str, default="default")
 parser.add_argument('--dataset_root', type=str, default="~/datasets")
 
 parser.add_argument('--train_mode', type=str, default="vanilla")
+parser.add_argument('--cuda_graph', action='store_true',
+                    help='Capture the vanilla training step as a CUDA Graph (single GPU)')
+parser.add_argument('--save_samples', action='store_true',
+                    help='Save examples of the training/validation batches')
+parser.add_argument('--compile', action='store_true',
+                    help='Compile the network with torch.compile (Inductor, single GPU)')
 
 parser.add_argument('--cut_prob', type=float, default=0.5)
 parser.add_argument('--radius', type=int, default=4)
@@ -45,6 +51,16 @@ os.environ['CUDA_VISIBLE_DEVICES'] = args.gpus
 
 device = 'cuda' if torch.cuda.is_available() else 'cpu'
 
+# Launched with 'torchrun' : One process per GPU with DistributedDataParallel.
+distributed = 'LOCAL_RANK' in os.environ
+is_main = True
+if distributed:
+    torch.distributed.init_process_group('nccl')
+    local_rank = int(os.environ['LOCAL_RANK'])
+    torch.cuda.set_device(local_rank)
+    device = f'cuda:{local_rank}'
+    is_main = torch.distributed.get_rank() == 0
+
 dataset_root = args.dataset_root
 save_path = os.path.join("./results", args.expr_name)
 
@@ -58,28 +74,32 @@ num_workers = args.num_workers
 scheduler_step = args.scheduler_step
 
 os.makedirs(save_path, exist_ok=True)
-f_print = open(os.path.join(save_path, 'output.txt'), 'w')
-#sys.stdout = f_print # Change the standard output to the file we created.
+if is_main:
+    f_print = open(os.path.join(save_path, 'output.txt'), 'w')
+    #sys.stdout = f_print # Change the standard output to the file we created.
+else:
+    f_print = open(os.devnull, 'w')
+    sys.stdout = f_print # Print only from the main process.
 print(args)
 
 
 print(f"Building Dataloaders: {data_type}")
 
 if data_type == 'mosquitodl':
-    train_loader, valid_loader, num_classes = MosquitoDL_loaders(dataset_root, crop_size, batch_size, num_workers)
+    train_loader, valid_loader, num_classes = MosquitoDL_loaders(dataset_root, crop_size, batch_size, num_workers, distributed=distributed, drop_last=True)
 elif data_type == 'ip102':
-    train_loader, valid_loader, test_loader, num_classes = IP102(dataset_root, crop_size=args.crop_size, batch_size=args.batch_size, num_workers=args.num_workers)
+    train_loader, valid_loader, test_loader, num_classes = IP102(dataset_root, crop_size=args.crop_size, batch_size=args.batch_size, num_workers=args.num_workers, distributed=distributed, drop_last=True)
 elif 'cifar' in data_type:
     if data_type == 'cifar10':
-        train_loader, valid_loader, num_classes = CIFAR_loaders(dataset_root, '10', batch_size, num_workers)
+        train_loader, valid_loader, num_classes = CIFAR_loaders(dataset_root, '10', batch_size, num_workers, distributed=distributed, drop_last=True)
     elif data_type == 'cifar100':
-        train_loader, valid_loader, num_classes = CIFAR_loaders(dataset_root, '100', batch_size, num_workers)
+        train_loader, valid_loader, num_classes = CIFAR_loaders(dataset_root, '100', batch_size, num_workers, distributed=distributed, drop_last=True)
     else:
         assert f'Unrecognized \'{data_type}\' for CIFAR dataset.'
 elif data_type == 'imagenet':
-    train_loader, valid_loader, num_classes = ImageNet_loaders(dataset_root, batch_size, num_workers)
+    train_loader, valid_loader, num_classes = ImageNet_loaders(dataset_root, batch_size, num_workers, distributed=distributed, drop_last=True)
 elif data_type == 'cub200':
-    train_loader, valid_loader, num_classes = CUB200_loaders(dataset_root, crop_size, batch_size, num_workers)
+    train_loader, valid_loader, num_classes = CUB200_loaders(dataset_root, crop_size, batch_size, num_workers, distributed=distributed, drop_last=True)
 else:
     assert f'Unsupported Dataset Type \'{data_type}\'.'
 
@@ -94,18 +114,23 @@ else: # Using ImageNet version of resnet.
     if net_type == 'resnet50':
         model = models.resnet50(pretrained=args.pretrained)
         model.fc = nn.Linear(model.fc.in_features, num_classes)
-        model = nn.DataParallel(model)
     elif net_type == 'mobilenetv2':
         model = models.mobilenet_v2(pretrained=args.pretrained)
         model.classifier[1] = nn.Linear(model.classifier[1].in_features, num_classes)
-        model = nn.DataParallel(model)
     elif net_type == 'vgg16':
         model = models.vgg16(pretrained=args.pretrained)
         model.classifier[-1] = nn.Linear(model.classifier[-1].in_features, num_classes)
-        model = nn.DataParallel(model)
     else:
         assert "Invalid 'net_type' !"
 
+model = model.to(device)
+model = model.to(memory_format=torch.channels_last) # NHWC convolutions on tensor cores.
+
+if distributed:
+    model = nn.parallel.DistributedDataParallel(model, device_ids=[local_rank])
+else:
+    model = nn.DataParallel(model)
+
 if 'resnet' in net_type:
     stage_names = ['layer1','layer2','layer3','layer4']
 elif net_type == 'mobilenetv2':
@@ -117,7 +142,25 @@ else:
 
 model = Wrapper(model, stage_names) # Wrapper for registering hooks for 'stage_names' of the 'model'.
 
-model = model.to(device)
+if args.compile:
+    assert hasattr(torch, 'compile'), "'--compile' requires PyTorch >= 2.0."
+    assert distributed or torch.cuda.device_count() <= 1, "'--compile' does not support nn.DataParallel replicas."
+    assert not args.cuda_graph, "Use either '--compile' or '--cuda_graph'."
+
+    # 'forward' is compiled instead of wrapping the modules, to keep the keys of the state_dict.
+    if train_mode == 'hybrid':
+        # Outputs of the stages are used by 'torch.autograd.grad' for the CAM.
+        # Only 'forward' of each stage is compiled. The hooks of 'Wrapper' run in the eager
+        # '__call__' of the stage, outside of the compiled regions.
+        for L in stage_names:
+            for k, v in model.net.named_modules():
+                if L in k:
+                    v.forward = torch.compile(v.forward)
+                    break
+    else:
+        # The stage activations are not used. Remove the hooks so they are not traced into the graph.
+        model.remove_hooks()
+        model.net.module.forward = torch.compile(model.net.module.forward, mode='reduce-overhead')
 print(f"\t - Done !")
 
 
@@ -125,11 +168,26 @@ print("Building Optimizer Related Objects")
 criterion = torch.nn.CrossEntropyLoss()
 optimizer = optim.SGD(model.parameters(), lr=args.learning_rate, weight_decay=args.weight_decay, momentum=0.9)
 scheduler = optim.lr_scheduler.StepLR(optimizer, step_size=args.scheduler_step, gamma=0.1)
+scaler = torch.cuda.amp.GradScaler(enabled=(device != 'cpu')) # Mixed precision (AMP) on GPUs.
 print(f"\t - Done !")
+
+graph_step = None
+if args.cuda_graph:
+    assert hasattr(torch.cuda, 'CUDAGraph'), "'--cuda_graph' requires PyTorch >= 1.10."
+    assert train_mode == 'vanilla', "CUDA Graph capture is only supported for the 'vanilla' training mode."
+    assert not distributed and device == 'cuda' and torch.cuda.device_count() == 1, "CUDA Graph capture requires a single GPU."
+
+    print("Capturing CUDA Graph for the training step")
+    model.train()
+    sample_batch, sample_labels = next(iter(train_loader))
+    graph_step = capture_train_step(model, optimizer, criterion, scaler, \
+        sample_batch.to(device, memory_format=torch.channels_last), sample_labels.to(device))
+    print(f"\t - Done !")
 # %%
 
-logs = []
-logs.append(['epoch', 'loss_tr', 'acc_tr', 'loss_val', 'acc_val', 'loss_test', 'acc_test'])
+f_log = open(os.path.join(save_path, 'log.csv') if is_main else os.devnull, 'w', newline='')
+log_writer = csv.writer(f_log)
+log_writer.writerow(['epoch', 'loss_tr', 'acc_tr', 'loss_val', 'acc_val', 'loss_test', 'acc_test'])
 elapsed_time = 0
 best_model = None
 best_valid_acc = 0
@@ -141,20 +199,25 @@ for epoch in range(num_epochs):
 
     epoch_start_t = time.time()
 
+    if distributed:
+        train_loader.sampler.set_epoch(epoch)
+
     print(f"\t - Train/Val Phase ...")
 
+    sample_path = save_path if (is_main and args.save_samples) else None # Batch examples from the main process only.
+
     if train_mode == 'vanilla':
         model, epoch_train_loss, epoch_train_acc = \
             train(model, train_loader, optimizer, scheduler, criterion, epoch, device, \
-            net_type='resnet', save_path=save_path)
+            net_type='resnet', save_path=sample_path, scaler=scaler, graph_step=graph_step)
     elif train_mode == 'cutmix':
         model, epoch_train_loss, epoch_train_acc = \
             train_CutMix(model, train_loader, optimizer, scheduler, criterion, epoch, device, \
-            net_type='resnet', cut_prob=args.cut_prob, save_path=save_path)
+            net_type='resnet', cut_prob=args.cut_prob, save_path=sample_path, scaler=scaler)
     elif train_mode == 'hybrid':
         model, epoch_train_loss, epoch_train_acc = \
             train_HybridPartSwapping(model, train_loader, optimizer, scheduler, criterion, epoch, device, \
-            net_type='resnet', save_path=save_path, \
+            net_type='resnet', save_path=sample_path, scaler=scaler, \
             cut_prob=args.cut_prob, radius=args.radius, num_proposals=args.num_proposals)
     else:
         assert 'Invalid training mode !'
@@ -163,19 +226,13 @@ for epoch in range(num_epochs):
     print(f"\t - Epoch training accuracy : {epoch_train_acc*100:.4f}%")
 
     print(f"\t - Validation Phase ...")
-    model, epoch_valid_loss, epoch_valid_acc = test(model, valid_loader, criterion, device, save_path, epoch)
+    model, epoch_valid_loss, epoch_valid_acc = test(model, valid_loader, criterion, device, sample_path, epoch)
     print(f"\t - Epoch validation loss : {epoch_valid_loss:.4f}")
     print(f"\t - Epoch validation accuracy : {epoch_valid_acc*100:.4f}%")
 
-    logs.append([epoch, epoch_train_loss, epoch_train_acc, \
+    log_writer.writerow([epoch, epoch_train_loss, epoch_train_acc, \
         epoch_valid_loss, epoch_valid_acc])
 
-    with open(os.path.join(save_path, 'log.csv'), 'w') as f:
-      
-        # using csv.writer method from CSV package
-        write = csv.writer(f)
-        write.writerows(logs)
-
     if epoch_valid_acc > best_valid_acc:
         best_valid_acc = epoch_valid_acc
 
@@ -185,8 +242,10 @@ for epoch in range(num_epochs):
             'model': model.state_dict(),
         }
 
-        print(f"Save best model with validation accuracy: {best_valid_acc*100:.4f}%")
-        torch.save(best_dict, os.path.join(save_path,'best_model.pth'))
+        if is_main:
+            print(f"Save best model with validation accuracy: {best_valid_acc*100:.4f}%")
+            torch.save(best_dict, os.path.join(save_path,'best_model.pth'))
+            f_log.flush()
 
     epoch_t = time.time() - epoch_start_t
     elapsed_time += epoch_t
@@ -202,5 +261,9 @@ for epoch in range(num_epochs):
 
 print(f"Finished with the best validation accuracy: {best_valid_acc*100:.4f}")
     
+f_log.close()
 f_print.close()
 
+if distributed:
+    torch.distributed.destroy_process_group()
+
@@ -1,12 +1,13 @@
 import os
 
 import torch
+from torch.utils.data.distributed import DistributedSampler
 from torchvision import datasets, transforms
 
 from utils.transforms_imagenet import *
 from utils.cub200 import CUB200
 
-def IP102(root, crop_size=224, batch_size=(64,64), num_workers=8):
+def IP102(root, crop_size=224, batch_size=(64,64), num_workers=8, distributed=False, drop_last=False):
     # Transforms: https://www.kaggle.com/mekouaryoussef/rendufinal
     # Official Settings (in CVPR2019)
     # BS = 64
@@ -36,13 +37,14 @@ def IP102(root, crop_size=224, batch_size=(64,64), num_workers=8):
     ])
 
     train_dataset = datasets.ImageFolder(os.path.join(root,'train'), transform=transforms_train)
-    train_loader = torch.utils.data.DataLoader(train_dataset, batch_size=bs_train, shuffle=True, num_workers=num_workers)
+    train_sampler = DistributedSampler(train_dataset) if distributed else None
+    train_loader = torch.utils.data.DataLoader(train_dataset, batch_size=bs_train, shuffle=(train_sampler is None), num_workers=num_workers, pin_memory=True, persistent_workers=(num_workers > 0), sampler=train_sampler, drop_last=drop_last)
 
     valid_dataset = datasets.ImageFolder(os.path.join(root,'val'), transform=transforms_test)
-    valid_loader = torch.utils.data.DataLoader(valid_dataset, batch_size=bs_test, shuffle=False, num_workers=num_workers)
+    valid_loader = torch.utils.data.DataLoader(valid_dataset, batch_size=bs_test, shuffle=False, num_workers=num_workers, pin_memory=True, persistent_workers=(num_workers > 0))
 
     test_dataset = datasets.ImageFolder(os.path.join(root,'test'), transform=transforms_test)
-    test_loader = torch.utils.data.DataLoader(test_dataset, batch_size=bs_test, shuffle=False, num_workers=num_workers)
+    test_loader = torch.utils.data.DataLoader(test_dataset, batch_size=bs_test, shuffle=False, num_workers=num_workers, pin_memory=True, persistent_workers=(num_workers > 0))
 
     num_classes = 102
 
@@ -50,7 +52,7 @@ def IP102(root, crop_size=224, batch_size=(64,64), num_workers=8):
     return train_loader, valid_loader, test_loader, num_classes
 
 
-def MosquitoDL_fold(root, crop_size=224, num_folds=5, batch_size=(64, 32), num_workers=8, ver='v2'):
+def MosquitoDL_fold(root, crop_size=224, num_folds=5, batch_size=(64, 32), num_workers=8, ver='v2', drop_last=False):
     '''
         Author: Junyoung Park (jy_park@inu.ac.kr)
         
@@ -58,6 +60,7 @@ def MosquitoDL_fold(root, crop_size=224, num_folds=5, batch_size=(64, 32), num_w
 
         num_folds(int): Use training data split with 'num_folds' for k-fold cross validation.
         crop_size(Tuple or int): if tuple, (bs_train, bs_test). if int, use bs_train = bs_test.
+        drop_last(bool): Drop the last partial training batch. (Static shapes for training)
 
     '''
 
@@ -107,17 +110,17 @@ def MosquitoDL_fold(root, crop_size=224, num_folds=5, batch_size=(64, 32), num_w
     train_dataset = torch.utils.data.random_split(train_dataset, fold_lengths)
 
     train_loader = {x: torch.utils.data.DataLoader(train_dataset[x], bs_train,
-                                                shuffle=True, num_workers=num_workers)
+                                                shuffle=True, num_workers=num_workers, pin_memory=True, persistent_workers=(num_workers > 0), drop_last=drop_last)
                     for x in range(num_folds)}
 
     test_dataset = datasets.ImageFolder(os.path.join(root,'valid'), transform=transforms_test)
-    test_loader = torch.utils.data.DataLoader(test_dataset, batch_size=32, shuffle=True, num_workers=num_workers)
+    test_loader = torch.utils.data.DataLoader(test_dataset, batch_size=32, shuffle=True, num_workers=num_workers, pin_memory=True, persistent_workers=(num_workers > 0))
 
     num_classes = 6
 
     return train_loader, test_loader, num_classes
 
-def CIFAR_loaders(root, type='10',batch_size=(64, 32), num_workers=4):
+def CIFAR_loaders(root, type='10',batch_size=(64, 32), num_workers=4, distributed=False, drop_last=False):
 
     if isinstance(batch_size, tuple):
         bs_train = batch_size[0]
@@ -141,27 +144,31 @@ def CIFAR_loaders(root, type='10',batch_size=(64, 32), num_workers=4):
     ])
 
     if type == '100':
+        train_dataset = datasets.CIFAR100(root, train=True, download=True, transform=transform_train)
+        train_sampler = DistributedSampler(train_dataset) if distributed else None
         train_loader = torch.utils.data.DataLoader(
-            datasets.CIFAR100(root, train=True, download=True, transform=transform_train),
-            batch_size=bs_train, shuffle=True, num_workers=num_workers, pin_memory=True)
+            train_dataset,
+            batch_size=bs_train, shuffle=(train_sampler is None), num_workers=num_workers, pin_memory=True, persistent_workers=(num_workers > 0), sampler=train_sampler, drop_last=drop_last)
         valid_loader = torch.utils.data.DataLoader(
             datasets.CIFAR100(root, train=False, transform=transform_test),
-            batch_size=bs_test, shuffle=True, num_workers=num_workers, pin_memory=True)
+            batch_size=bs_test, shuffle=True, num_workers=num_workers, pin_memory=True, persistent_workers=(num_workers > 0))
         num_classes = 100
     elif type == '10':
+        train_dataset = datasets.CIFAR10(root, train=True, download=True, transform=transform_train)
+        train_sampler = DistributedSampler(train_dataset) if distributed else None
         train_loader = torch.utils.data.DataLoader(
-            datasets.CIFAR10(root, train=True, download=True, transform=transform_train),
-            batch_size=bs_train, shuffle=True, num_workers=num_workers, pin_memory=True)
+            train_dataset,
+            batch_size=bs_train, shuffle=(train_sampler is None), num_workers=num_workers, pin_memory=True, persistent_workers=(num_workers > 0), sampler=train_sampler, drop_last=drop_last)
         valid_loader = torch.utils.data.DataLoader(
             datasets.CIFAR10(root, train=False, transform=transform_test),
-            batch_size=bs_test, shuffle=True, num_workers=num_workers, pin_memory=True)
+            batch_size=bs_test, shuffle=True, num_workers=num_workers, pin_memory=True, persistent_workers=(num_workers > 0))
         num_classes = 10
     else:
         assert "Invalid CIFAR type. (Should be 10 or 100)"
         
     return train_loader, valid_loader, num_classes
 
-def ImageNet_loaders(root, batch_size=(64, 32), num_workers=4):
+def ImageNet_loaders(root, batch_size=(64, 32), num_workers=4, distributed=False, drop_last=False):
     '''
         Modified from the original implementation by ClovaAI
     '''
@@ -196,11 +203,11 @@ def ImageNet_loaders(root, batch_size=(64, 32), num_workers=4):
             normalize,
         ]))
 
-    train_sampler = None
+    train_sampler = DistributedSampler(train_dataset) if distributed else None
 
     train_loader = torch.utils.data.DataLoader(
         train_dataset, batch_size=bs_train, shuffle=(train_sampler is None),
-        num_workers=num_workers, pin_memory=True, sampler=train_sampler)
+        num_workers=num_workers, pin_memory=True, persistent_workers=(num_workers > 0), sampler=train_sampler, drop_last=drop_last)
 
     val_loader = torch.utils.data.DataLoader(
         datasets.ImageFolder(valdir, transforms.Compose([
@@ -210,12 +217,12 @@ def ImageNet_loaders(root, batch_size=(64, 32), num_workers=4):
             normalize,
         ])),
         batch_size=bs_test, shuffle=False,
-        num_workers=num_workers, pin_memory=True)
+        num_workers=num_workers, pin_memory=True, persistent_workers=(num_workers > 0))
     num_classes = 1000
 
     return train_loader, val_loader, num_classes
 
-def CUB200_loaders(root, crop_size=224, batch_size=(64,32), num_workers=4):
+def CUB200_loaders(root, crop_size=224, batch_size=(64,32), num_workers=4, distributed=False, drop_last=False):
 
     if isinstance(batch_size, tuple):
         bs_train = batch_size[0]
@@ -241,19 +248,21 @@ def CUB200_loaders(root, crop_size=224, batch_size=(64,32), num_workers=4):
                                  std=(0.229, 0.224, 0.225))
     ])
     train_dataset = CUB200(root, transform = train_transforms, train=True, download=False)
-    train_loader = torch.utils.data.DataLoader(train_dataset, batch_size=bs_train, shuffle=True, num_workers=num_workers)
+    train_sampler = DistributedSampler(train_dataset) if distributed else None
+    train_loader = torch.utils.data.DataLoader(train_dataset, batch_size=bs_train, shuffle=(train_sampler is None), num_workers=num_workers, pin_memory=True, persistent_workers=(num_workers > 0), sampler=train_sampler, drop_last=drop_last)
     val_dataset = CUB200(root, transform = val_transforms, train=False, download=False)
-    val_loader = torch.utils.data.DataLoader(val_dataset, batch_size=bs_test, shuffle=True, num_workers=num_workers)
+    val_loader = torch.utils.data.DataLoader(val_dataset, batch_size=bs_test, shuffle=True, num_workers=num_workers, pin_memory=True, persistent_workers=(num_workers > 0))
 
     return train_loader, val_loader, num_classes
 
-def MosquitoDL_loaders(root, crop_size=224, batch_size=(64, 32), num_workers=4):
+def MosquitoDL_loaders(root, crop_size=224, batch_size=(64, 32), num_workers=4, distributed=False, drop_last=False):
     '''
         Author: Junyoung Park (jy_park@inu.ac.kr)
         
         Mosquito Classification DataLoader
 
         crop_size(Tuple or int): if tuple, (bs_train, bs_test). if int, use bs_train = bs_test.
+        drop_last(bool): Drop the last partial training batch. (Static shapes for training)
 
     '''
 
@@ -283,11 +292,12 @@ def MosquitoDL_loaders(root, crop_size=224, batch_size=(64, 32), num_workers=4):
 
     print(f"Dataset with length {len(train_dataset)}")
 
+    train_sampler = DistributedSampler(train_dataset) if distributed else None
     train_loader = torch.utils.data.DataLoader(train_dataset, bs_train,
-                                                shuffle=True, num_workers=num_workers)
+                                                shuffle=(train_sampler is None), num_workers=num_workers, pin_memory=True, persistent_workers=(num_workers > 0), sampler=train_sampler, drop_last=drop_last)
 
     test_dataset = datasets.ImageFolder(os.path.join(root,'valid'), transform=transforms_test)
-    test_loader = torch.utils.data.DataLoader(test_dataset, batch_size=bs_test, shuffle=False, num_workers=num_workers)
+    test_loader = torch.utils.data.DataLoader(test_dataset, batch_size=bs_test, shuffle=False, num_workers=num_workers, pin_memory=True, persistent_workers=(num_workers > 0))
 
     num_classes = 6
 
@@ -11,66 +11,49 @@ Given attention map F, num. of proposals N_proposals, radius r
 3.
 
 '''
-def generate_attentive_mask(attention_map, radius=1, num_proposals=3, allow_boundary=False):
+def attentive_region(attention_map, radius=1, num_proposals=3, allow_boundary=False):
     """
-        Author: Junyoung Park (jy_park@inu.ac.kr)
         Input:
             attention_map   (Tensor) : NxWxH tensor after GAP.
-            radius           (Tensor)
+            radius           (int)
         Output:
-            mask            (Tensor) : NxWxH tensor for masking attentive regions
-            coords          (Tensor) : Normalized coordinates(cx, cy) for masked regions
+            x_min, x_max, y_min, y_max (Tensor) : [N] tensors for the attentive square regions.
+
+        Vectorized over the batch. (No per-sample loop and no host syncs)
     """
     N, W, H = attention_map.shape
+    radius = int(radius)
 
     x = attention_map.reshape([N, W *H])
 
-    _, indices = torch.sort(x, descending=True, dim=1)
+    _, indices = torch.topk(x, num_proposals, dim=1) # [N, Most Intensive]
 
     if num_proposals == 1:
-        targets = indices[:, 0] # [N, Most Intensive]
+        targets = indices[:, 0]
     else:
-        targets = indices[:, 0:num_proposals] # [N, Most Intensive]
-        idx_proposal = torch.randint(low=0, high=num_proposals, size=(1,))[0]
-        targets = targets[:, idx_proposal]
-
-    mask = torch.ones_like(attention_map)
-
-    for i in range(N):
-        (top_x, top_y) = (targets[i]//W , targets[i]%W)
-
-        # Get x, y constraint
-        x_min, x_max = (top_x - radius, top_x + radius + 1)
-        y_min, y_max = (top_y - radius, top_y + radius + 1)
-
-        # To keep the region in square shape
-        if allow_boundary == False:
-            if x_min < 0:
-                x_min = 0
-                x_max = radius*2 + 1
-            if x_max > W - 1:
-                x_min = W - 1 - radius*2
-                x_max = W
-            if y_min < 0:
-                y_min = 0
-                y_max = radius*2 + 1
-            if y_max > H - 1:
-                y_min = H - 1 - radius*2
-                y_max = H
-
-        # For debugging
-        # print(f"x: ({x_min},{x_max})")
-        # print(f"y: ({y_min},{y_max})")
-        
-        for x in range(x_min, x_max):
-            for y in range(y_min, y_max):
-                if (x < 0 or x >= W) or (y < 0 or y >= H):
-                    continue
-                mask[i, x, y] = 0
-        
-    return mask
+        idx_proposal = np.random.randint(low=0, high=num_proposals)
+        targets = indices[:, idx_proposal]
 
-def generate_attentive_box(attention_map, radius=1, num_proposals=3, allow_boundary=False):
+    (top_x, top_y) = (targets//W , targets%W)
+
+    # Get x, y constraint
+    x_min, x_max = (top_x - radius, top_x + radius + 1)
+    y_min, y_max = (top_y - radius, top_y + radius + 1)
+
+    # To keep the region in square shape
+    if allow_boundary == False:
+        under = x_min < 0
+        x_min, x_max = x_min.masked_fill(under, 0), x_max.masked_fill(under, radius*2 + 1)
+        over = x_max > W - 1
+        x_min, x_max = x_min.masked_fill(over, W - 1 - radius*2), x_max.masked_fill(over, W)
+        under = y_min < 0
+        y_min, y_max = y_min.masked_fill(under, 0), y_max.masked_fill(under, radius*2 + 1)
+        over = y_max > H - 1
+        y_min, y_max = y_min.masked_fill(over, H - 1 - radius*2), y_max.masked_fill(over, H)
+
+    return x_min, x_max, y_min, y_max
+
+def generate_attentive_mask(attention_map, radius=1, num_proposals=3, allow_boundary=False):
     """
         Author: Junyoung Park (jy_park@inu.ac.kr)
         Input:
@@ -78,55 +61,51 @@ def generate_attentive_box(attention_map, radius=1, num_proposals=3, allow_bound
             radius           (Tensor)
         Output:
             mask            (Tensor) : NxWxH tensor for masking attentive regions
-            coords          (Tensor) : Normalized coordinates(cx, cy) for masked regions
     """
     N, W, H = attention_map.shape
 
-    x = attention_map.reshape([N, W *H])
+    x_min, x_max, y_min, y_max = attentive_region(attention_map, radius, num_proposals, allow_boundary)
 
-    _, indices = torch.sort(x, descending=True, dim=1)
+    xs = torch.arange(W, device=attention_map.device).view(1, W, 1)
+    ys = torch.arange(H, device=attention_map.device).view(1, 1, H)
+
+    # Coordinates out of the map are never inside, as in the original per-pixel loop.
+    inside = (xs >= x_min.view(N, 1, 1)) & (xs < x_max.view(N, 1, 1)) & \
+             (ys >= y_min.view(N, 1, 1)) & (ys < y_max.view(N, 1, 1))
+
+    mask = torch.ones_like(attention_map).masked_fill(inside, 0)
+
+    return mask
+
+def generate_attentive_box(attention_map, radius=1, num_proposals=3, allow_boundary=False):
+    """
+        Author: Junyoung Park (jy_park@inu.ac.kr)
+        Input:
+            attention_map   (Tensor) : NxWxH tensor after GAP.
+            radius           (Tensor)
+        Output:
+            coords          (Tensor) : Nx4 tensor (x_min, x_max, y_min, y_max) for attentive regions
+    """
+    x_min, x_max, y_min, y_max = attentive_region(attention_map, radius, num_proposals, allow_boundary)
+
+    coords = torch.stack([x_min, x_max, y_min, y_max], dim=1).float()
 
-    if num_proposals == 1:
-        targets = indices[:, 0] # [N, Most Intensive]
-    else:
-        targets = indices[:, 0:num_proposals] # [N, Most Intensive]
-        idx_proposal = torch.randint(low=0, high=num_proposals, size=(1,))[0]
-        targets = targets[:, idx_proposal]
-
-    mask = torch.ones_like(attention_map)
-
-    coords = torch.zeros([N, 4])
-
-    for i in range(N):
-        (top_x, top_y) = (targets[i]//W , targets[i]%W)
-
-        # Get x, y constraint
-        x_min, x_max = (top_x - radius, top_x + radius + 1)
-        y_min, y_max = (top_y - radius, top_y + radius + 1)
-
-        # To keep the region in square shape
-        if allow_boundary == False:
-            if x_min < 0:
-                x_min = 0
-                x_max = radius*2 + 1
-            if x_max > W - 1:
-                x_min = W - 1 - radius*2
-                x_max = W
-            if y_min < 0:
-                y_min = 0
-                y_max = radius*2 + 1
-            if y_max > H - 1:
-                y_min = H - 1 - radius*2
-                y_max = H
-
-        coords[i] = torch.Tensor([x_min, x_max, y_min, y_max])
-
-        # For debugging
-        # print(f"x: ({x_min},{x_max})")
-        # print(f"y: ({y_min},{y_max})")
-        
     return coords
 
+@torch.jit.script
+def compute_cam(fmap: torch.Tensor, grads: torch.Tensor) -> torch.Tensor:
+    """
+        Grad-CAM as a single scripted function, so that the pointwise ops can be fused.
+        Input:
+            fmap            (Tensor) : NxCxWxH feature map of the target stage.
+            grads           (Tensor) : NxCxWxH gradients w.r.t. 'fmap'.
+        Output:
+            cam             (Tensor) : NxWxH class activation map.
+    """
+    importance_weights = F.adaptive_avg_pool2d(grads, 1) # [N x C x 1 x 1]
+    cam = (fmap * importance_weights).sum(dim=1) # [N x W x H]
+    return F.relu(cam)
+
 class Wrapper(nn.Module):
     '''
         Author: Junyoung Park (jy_park@inu.ac.kr)
@@ -134,54 +113,97 @@ class Wrapper(nn.Module):
     def __init__(self, model, stage_names):
         super(Wrapper, self).__init__()
 
-        self.dict_activation = {}
-        self.dict_gradients = {}
+        # [stage_index][device] : Indexed by the position in 'stage_names'.
+        self.activations = []
         self.forward_hook_handles = []
-        self.backward_hook_handles = []
 
         self.net = model
         self.stage_names = stage_names
         self.num_stages = len(self.stage_names)
 
-        def forward_hook_function(name): # Hook function for the forward pass.
+        def forward_hook_function(stage_index): # Hook function for the forward pass.
             def get_class_activation(module, input, output):
-                self.dict_activation[name][torch.cuda.current_device()] = output.data
+                self.activations[stage_index][torch.cuda.current_device()] = output # Kept in the graph for 'torch.autograd.grad'.
             return get_class_activation
 
-        def backward_hook_function(name): # Hook function for the backward pass. ver=1.7.1
-            def get_class_gradient(module, input, output):
-                self.dict_gradients[name][torch.cuda.current_device()] = output[0]
-            return get_class_gradient
-
-        for L in self.stage_names:
+        for i, L in enumerate(self.stage_names):
             for k, v in self.net.named_modules():
                 if L in k:
-                    self.forward_hook_handles.append(v.register_forward_hook(forward_hook_function(L)))
-                    self.backward_hook_handles.append(v.register_full_backward_hook(backward_hook_function(L)))
-                    print(f"Registered forward/backward hook on \'{k}\'")
+                    self.forward_hook_handles.append(v.register_forward_hook(forward_hook_function(i)))
+                    print(f"Registered forward hook on \'{k}\'")
                     break
 
+        self.clear_dict()
+
     def forward(self, x):
         self.clear_dict()
         return self.net(x)
             
+    def remove_hooks(self):
+        for handle in self.forward_hook_handles:
+            handle.remove()
+        self.forward_hook_handles = []
+
     def print_current_dicts(self):
-        for k, v in self.dict_activation.items():
+        for k, v in zip(self.stage_names, self.activations):
             print("[FW] Layer:", k)
             print("[FW] Shape-0:", v[0].shape)
-        for k, v in self.dict_gradients.items():
-            print("[BW] Layer:", k)      
-            print("[BW] Shape-0:", v[0].shape,flush=True)
 
     def clear_dict(self):
-        for sname in self.stage_names:
-            self.dict_activation[sname]=None
-            self.dict_gradients[sname]=None
-        # print(self.dict_activation.keys())
-        # print(self.dict_activation)
-        for k, v in self.dict_activation.items():
-            self.dict_activation[k]=[None for item in range(torch.cuda.device_count())]
-            self.dict_gradients[k]=[None for item in range(torch.cuda.device_count())]
+        self.activations = [[None for item in range(torch.cuda.device_count())] for _ in range(self.num_stages)]
+
+
+class DataPrefetcher():
+    '''
+        Modified from NVIDIA apex (examples/imagenet/main_amp.py)
+
+        Copies the next batch to the device on a side CUDA stream while the current one is used.
+        loader(DataLoader): Source loader. (Use pin_memory=True for asynchronous copies)
+        memory_format(torch.memory_format): Memory format of the input batch on the device.
+    '''
+    def __init__(self, loader, device, memory_format=torch.contiguous_format):
+        self.loader = iter(loader)
+        self.device = device
+        self.memory_format = memory_format
+        self.stream = torch.cuda.Stream() if device != 'cpu' else None
+
+        self.preload()
+
+    def preload(self):
+        try:
+            self.next_input, self.next_target = next(self.loader)
+        except StopIteration:
+            self.next_input = None
+            self.next_target = None
+            return
+
+        if self.stream == None:
+            self.next_input = self.next_input.to(memory_format=self.memory_format)
+            return
+
+        with torch.cuda.stream(self.stream):
+            self.next_input = self.next_input.to(self.device, non_blocking=True)
+            self.next_input = self.next_input.to(memory_format=self.memory_format)
+            self.next_target = self.next_target.to(self.device, non_blocking=True)
+
+    def next(self):
+        if self.stream != None:
+            torch.cuda.current_stream().wait_stream(self.stream)
+
+        input, target = self.next_input, self.next_target
+        if input is not None and self.stream != None:
+            # Tensors were allocated on the side stream but are used on the current one.
+            input.record_stream(torch.cuda.current_stream())
+            target.record_stream(torch.cuda.current_stream())
+
+        self.preload()
+        return input, target
+
+    def __iter__(self):
+        input, target = self.next()
+        while input is not None:
+            yield input, target
+            input, target = self.next()
 
 
 def rand_bbox(size, lam): 
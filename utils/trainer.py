@@ -4,15 +4,63 @@ from torch.nn.modules import activation
 from torchvision.utils import make_grid
 
 import os
+import copy
+import contextlib
 import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.cm as cm
+from matplotlib.figure import Figure
+from concurrent.futures import ThreadPoolExecutor
 import cv2
 
 from utils.trainer import *
-from utils.misc import generate_attentive_box, rand_bbox
+from utils.misc import generate_attentive_box, rand_bbox, compute_cam, DataPrefetcher
 
 
+sample_executor = ThreadPoolExecutor(max_workers=1) # Plots batch examples off the training thread.
+sample_futures = [] # Pending plots, checked by 'wait_batch_samples'.
+
+def save_batch_sample(batch, title, file_path, figsize):
+    """
+        save_batch_sample - Save a grid of the batch images without blocking the training loop.
+
+        The batch is copied to pinned host memory on the current stream, and plotted on a worker thread.
+        (matplotlib.figure.Figure instead of pyplot, which is not thread-safe)
+    """
+    batch = batch.detach()
+
+    if batch.is_cuda:
+        batch_cpu = torch.empty(batch.shape, dtype=batch.dtype, pin_memory=True)
+        batch_cpu.copy_(batch, non_blocking=True)
+        copy_done = torch.cuda.Event()
+        copy_done.record()
+    else:
+        batch_cpu = batch.clone()
+        copy_done = None
+
+    def plot():
+        if copy_done != None:
+            copy_done.synchronize()
+
+        input_ex = make_grid(batch_cpu.float(), normalize=True, nrow=8, padding=2).permute([1,2,0])
+        fig = Figure(figsize=figsize)
+        ax = fig.subplots(1,1)
+        ax.imshow(input_ex)
+        ax.set_title(title)
+        ax.axis('off')
+        fig.savefig(file_path)
+
+    future = sample_executor.submit(plot)
+    sample_futures.append(future)
+
+    return future
+
+def wait_batch_samples():
+    """
+        wait_batch_samples - Wait for the pending batch examples. Re-raises an error from plotting or saving.
+    """
+    while sample_futures:
+        sample_futures.pop(0).result()
 
 def train_HybridPartSwapping(model, train_loader, optimizer, scheduler, criterion, cur_epoch, device, **kwargs):
     """
@@ -31,63 +79,64 @@ def train_HybridPartSwapping(model, train_loader, optimizer, scheduler, criterio
     save_path = kwargs['save_path']
     radius = kwargs['radius']
     num_proposals = kwargs['num_proposals']
+    scaler = kwargs['scaler']
     model.train()
 
-    train_loss = 0
-    train_n_corrects = 0
+    # Accumulated on the device to avoid a host sync on every iteration.
+    train_loss = torch.zeros((), device=device)
+    train_n_corrects = torch.zeros((), device=device, dtype=torch.long)
     train_n_samples = 0
 
     is_plot_generated = False
 
-    for idx, data in enumerate(train_loader):
+    one_hot = None # Reused across iterations.
 
-        batch, labels = data[0].to(device), data[1].to(device)
+    # Permutations for every step of the epoch at once. (One row per step)
+    perm_pool = torch.rand(len(train_loader), train_loader.batch_size).argsort(dim=1)
+    perm_pool_list = perm_pool.tolist() # For the box swapping loop on the host.
+    perm_pool = perm_pool.to(device, non_blocking=True)
+
+    for idx, (batch, labels) in enumerate(DataPrefetcher(train_loader, device, torch.channels_last)):
         
-        optimizer.zero_grad()
+        optimizer.zero_grad(set_to_none=True)
+
+        r = np.random.rand(1)[0]
 
-        pred = model(batch)
+        # The CAM forward pass is not followed by a backward pass for the parameters.
+        # (No gradient reduction of DistributedDataParallel for it)
+        if r < cut_prob and hasattr(model.net, 'no_sync'):
+            cam_context = model.net.no_sync()
+        else:
+            cam_context = contextlib.nullcontext()
+
+        with cam_context, torch.cuda.amp.autocast(enabled=scaler.is_enabled()):
+            pred = model(batch)
         pred_max = torch.argmax(pred, 1)
 
         target_stage_name = 'None'
 
-        r = np.random.rand(1)[0]
-
         param_info = ''
         if r < cut_prob:
             target_stage_index = model.num_stages - 1
 
             target_stage_name = model.stage_names[target_stage_index]
 
-            # loss = criterion(pred, labels)
-            
-            # loss.backward()
-
-            one_hot = torch.FloatTensor(batch.shape[0], pred.size()[-1]).zero_()
-            # print("one_hot shape:" + str(one_hot.shape))
-            for i in range(len(labels)):
-                one_hot[i,labels[i]-1] = 1.0
-            # one_hot[:,labels] = 1.0
-            # print("min labels:" + str(labels.min()))
-            # print("labels:" + str(labels[0:5]))
-            # print("one_hot:")
-            # print(one_hot[0:5,:])
-            one_hot = one_hot.to('cuda:'+str(torch.cuda.current_device()))
-            pred.backward(gradient=one_hot, retain_graph=False)
-
-
-            # print("shape of model.dict_activation:" + str(model.dict_activation[target_stage_name][0].shape))
-            # print("shape of model.dict_gradients:" + str((model.dict_gradients[target_stage_name][0].shape)))
-
-            # gather activation and gradients from multiple gpus            
-            dict_activation = [item.to('cuda:'+str(torch.cuda.current_device())) for item in model.dict_activation[target_stage_name]]
-            dict_gradients = [item.to('cuda:'+str(torch.cuda.current_device())) for item in model.dict_gradients[target_stage_name]]
-            # dict_activation = [item.to('cuda:'+str(torch.cuda.current_device())) for item in model.dict_activation[target_stage_name][::-1]]
-            # dict_gradients = [item.to('cuda:'+str(torch.cuda.current_device())) for item in model.dict_gradients[target_stage_name][::-1]]
+            # Gradients of the target class scores w.r.t. the target stage only.
+            # (No backward pass through the whole network / parameters for the CAM)
+            if one_hot is None or one_hot.shape != pred.shape or one_hot.dtype != pred.dtype:
+                one_hot = torch.empty_like(pred)
+            one_hot.zero_().scatter_(1, ((labels - 1) % pred.size(-1)).unsqueeze(1), 1.0) # one_hot[i, labels[i]-1] = 1.0
+
+            # gather activation and gradients from multiple gpus
+            stage_activation = [item for item in model.activations[target_stage_index] if item is not None] # DDP: Local GPU only.
+            stage_gradients = torch.autograd.grad(pred, stage_activation, grad_outputs=one_hot, retain_graph=False)
+
+            dict_activation = [item.detach().to('cuda:'+str(torch.cuda.current_device())) for item in stage_activation]
+            dict_gradients = [item.to('cuda:'+str(torch.cuda.current_device())) for item in stage_gradients]
 
             target_fmap = torch.cat(dict_activation, dim=0)
             target_gradients = torch.cat(dict_gradients, dim=0)
             
-            optimizer.zero_grad()
             model.clear_dict()
 
             N, C, W_f, H_f = target_fmap.shape
@@ -96,40 +145,50 @@ def train_HybridPartSwapping(model, train_loader, optimizer, scheduler, criterio
             #l2_norm = torch.sqrt(torch.mean(torch.pow(target_gradients, 2))) + 1e-5
             #target_gradients = target_gradients / l2_norm
 
-            importance_weights = F.adaptive_avg_pool2d(target_gradients, 1) # [N x C x 1 x 1]
-
-            class_activation_map = torch.mul(target_fmap, importance_weights).sum(dim=1, keepdim=True) # [N x 1 x W_f x H_f]
-            class_activation_map = F.relu(class_activation_map).squeeze(dim=1) # [N x W_f x H_f]
+            # FP32 inputs for the proposal sorting under AMP, NHWC like the activations of the model.
+            class_activation_map = compute_cam(target_fmap.float().contiguous(memory_format=torch.channels_last), \
+                target_gradients.float().contiguous(memory_format=torch.channels_last)) # [N x W_f x H_f]
 
             # print("min:" + str(class_activation_map.min()))
             # print("max:" + str(class_activation_map.max()))
 
             #radius = torch.randint(low=0, high=radius+1,size=[1])[0]
-            rand_radius = torch.randint(low=max(radius-1,0), high=min(radius+1, class_activation_map.shape[1]), size=[1])[0]
+            rand_radius = np.random.randint(low=max(radius-1,0), high=min(radius+1, class_activation_map.shape[1]))
 
             # Get Image A mask
             # Get Image B mask
             # Overwrite target region on A to target of B
-            attention_box = generate_attentive_box(class_activation_map, radius=rand_radius, num_proposals=num_proposals, allow_boundary=False) # [N, W, H]
+            attention_box = generate_attentive_box(class_activation_map, radius=rand_radius, num_proposals=num_proposals, allow_boundary=False) # [N, 4]
             attention_box = (attention_box/W_f)*batch.shape[2] # Scaling attention box from the feature size to the original image size.
             # print(attention_box)
             # exit()
 
             param_info = f', Radius: {rand_radius}, Num. Proposals: {num_proposals}'
 
-            rand_index = torch.randperm(batch.size()[0]).cuda() 
-            batch_original = batch.clone().detach()
+            if batch.size()[0] == perm_pool.size(1):
+                rand_index = perm_pool[idx]
+                rand_index_list = perm_pool_list[idx]
+            else:
+                rand_index_list = torch.randperm(batch.size()[0]).tolist()
+                rand_index = torch.tensor(rand_index_list).to(device, non_blocking=True)
             #print("rand_index:" + str(rand_index), flush=True)
             # for i,v in enumerate(rand_index):
             #     print(str(i) + "\t" + str(v), flush=True)
 
+            # Box coordinates to the host at once, instead of a sync per element.
+            box_list = attention_box.int().tolist()
+
+            # Copy only the source regions of image B before overwriting, not the whole batch.
+            patches_b = []
+            for batch_idx in range(batch.shape[0]):
+                target_idx = rand_index_list[batch_idx]
+                x_min_b, x_max_b, y_min_b, y_max_b = box_list[target_idx]
+                patches_b.append(batch[target_idx, :, x_min_b:x_max_b, y_min_b:y_max_b].clone())
+
             for batch_idx in range(batch.shape[0]):
-                target_idx = rand_index[batch_idx] 
-                x_min_a, x_max_a, y_min_a, y_max_a = attention_box[batch_idx].int()
-                x_min_b, x_max_b, y_min_b, y_max_b = attention_box[target_idx].int()
+                x_min_a, x_max_a, y_min_a, y_max_a = box_list[batch_idx]
                 # print(f'Image A({batch_idx}): ({x_min_a},{y_min_a}), ({x_max_a},{y_max_a})')
-                # print(f'Image B({target_idx}): ({x_min_b},{y_min_b}), ({x_max_b},{y_max_b})\n')
-                batch[batch_idx, :, x_min_a:x_max_a, y_min_a:y_max_a] = batch_original[target_idx, :, x_min_b:x_max_b, y_min_b:y_max_b]
+                batch[batch_idx, :, x_min_a:x_max_a, y_min_a:y_max_a] = patches_b[batch_idx]
 
                
             n_mix = (rand_radius + 1) ** 2 # Number of zeros in attention_mask
@@ -138,51 +197,99 @@ def train_HybridPartSwapping(model, train_loader, optimizer, scheduler, criterio
             target_a = labels
             target_b = labels[rand_index]
 
-            pred = model(batch)
-            pred_max = torch.argmax(pred, 1)
-            # print(rand_radius)
-            # print(1-mix_ratio)
-            # print(mix_ratio)
+            with torch.cuda.amp.autocast(enabled=scaler.is_enabled()):
+                pred = model(batch)
+                # print(rand_radius)
+                # print(1-mix_ratio)
+                # print(mix_ratio)
 
-            if target_stage_index < 3:          # Fine grained features
-                loss = criterion(pred, labels)  # - No label mixing
-            else:
-                loss = criterion(pred, target_a) * (1 - mix_ratio) + criterion(pred, target_b) * (mix_ratio)
+                if target_stage_index < 3:          # Fine grained features
+                    loss = criterion(pred, labels)  # - No label mixing
+                else:
+                    loss = criterion(pred, target_a) * (1 - mix_ratio) + criterion(pred, target_b) * (mix_ratio)
+            pred_max = torch.argmax(pred, 1)
 
-            if (is_plot_generated == False and cur_epoch % 5 == 0):
+            if (save_path != None and is_plot_generated == False and cur_epoch % 5 == 0):
                 # generate a grid of batch images
-                input_ex = make_grid(batch.detach().cpu(), normalize=True, nrow=8, padding=2).permute([1,2,0])
-                fig, ax = plt.subplots(1,1,figsize=(8*2,2*(batch.size(0)//8)+1))
-                ax.imshow(input_ex)
-                ax.set_title(f"Train Original Batch Examples\nCut_Prob:{cut_prob}, Cur_Target: {target_stage_name}, {param_info}")
-                ax.axis('off')
-                fig.savefig(os.path.join(save_path, f"Train_Orig_BatchSample_E{cur_epoch}_I{idx}.png"))
-                plt.draw()
-                plt.clf()
-                plt.close("all")
+                save_batch_sample(batch, f"Train Original Batch Examples\nCut_Prob:{cut_prob}, Cur_Target: {target_stage_name}, {param_info}", \
+                    os.path.join(save_path, f"Train_Orig_BatchSample_E{cur_epoch}_I{idx}.png"), figsize=(8*2,2*(batch.size(0)//8)+1))
 
                 is_plot_generated = True
             
 
         else:
-            loss = criterion(pred, labels)
+            with torch.cuda.amp.autocast(enabled=scaler.is_enabled()):
+                loss = criterion(pred, labels)
 
             
             
-        train_loss += loss.detach().cpu().numpy()
+        train_loss += loss.detach().float()
         train_n_samples += labels.size(0)
-        train_n_corrects += torch.sum(pred_max == labels).detach().cpu().numpy()
-        optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
+        train_n_corrects += torch.sum(pred_max == labels)
+        optimizer.zero_grad(set_to_none=True)
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
     
     scheduler.step()
 
-    epoch_train_loss = train_loss / len(train_loader)
-    epoch_train_acc = train_n_corrects/train_n_samples
+    epoch_train_loss = train_loss.item() / len(train_loader)
+    epoch_train_acc = train_n_corrects.item()/train_n_samples
+
+    wait_batch_samples()
 
     return model, epoch_train_loss, epoch_train_acc
 
+def capture_train_step(model, optimizer, criterion, scaler, batch, labels, num_warmup=3):
+    """
+        capture_train_step - Capture the forward/backward pass of 'train' as a CUDA Graph.
+
+        model(torch.nn.Module): Target model to train. (Single GPU only)
+        batch, labels(Tensor): Sample batch on the target device. Fixes the static shapes.
+        Output:
+            graph_step(dict): Graph and its static input/target/pred/loss tensors.
+
+        Only the forward/backward pass is captured. 'scaler.step(optimizer)' is run eagerly
+        after each replay so that the learning rate schedule and the loss scaling keep working.
+    """
+    static_input = batch.clone()
+    static_target = labels.clone()
+
+    initial_state = copy.deepcopy(model.state_dict()) # Warmup passes update BN statistics.
+
+    # Warmup on a side stream before the capture.
+    s = torch.cuda.Stream()
+    s.wait_stream(torch.cuda.current_stream())
+    with torch.cuda.stream(s):
+        for _ in range(num_warmup):
+            optimizer.zero_grad(set_to_none=True)
+            with torch.cuda.amp.autocast(enabled=scaler.is_enabled(), cache_enabled=False):
+                pred = model(static_input)
+                loss = criterion(pred, static_target)
+            scaler.scale(loss).backward()
+    torch.cuda.current_stream().wait_stream(s)
+
+    # Gradients are allocated inside the graph's memory pool, and overwritten on each replay.
+    graph = torch.cuda.CUDAGraph()
+    optimizer.zero_grad(set_to_none=True)
+    with torch.cuda.graph(graph):
+        with torch.cuda.amp.autocast(enabled=scaler.is_enabled(), cache_enabled=False):
+            static_pred = model(static_input)
+            static_loss = criterion(static_pred, static_target)
+        scaler.scale(static_loss).backward()
+
+    model.load_state_dict(initial_state)
+
+    graph_step = {
+        'graph': graph,
+        'static_input': static_input,
+        'static_target': static_target,
+        'static_pred': static_pred,
+        'static_loss': static_loss,
+    }
+
+    return graph_step
+
 def train(model, train_loader, optimizer, scheduler, criterion, cur_epoch, device, **kwargs):
     """
         train - Training code with vanilla method
@@ -193,46 +300,55 @@ def train(model, train_loader, optimizer, scheduler, criterion, cur_epoch, devic
     """
 
     save_path = kwargs['save_path']
+    scaler = kwargs['scaler']
+    graph_step = kwargs.get('graph_step', None) # From 'capture_train_step'.
 
     model.train()
 
-    train_loss = 0
-    train_n_corrects = 0
+    # Accumulated on the device to avoid a host sync on every iteration.
+    train_loss = torch.zeros((), device=device)
+    train_n_corrects = torch.zeros((), device=device, dtype=torch.long)
     train_n_samples = 0
 
-    for idx, data in enumerate(train_loader):
+    for idx, (batch, labels) in enumerate(DataPrefetcher(train_loader, device, torch.channels_last)):
 
-        batch, labels = data[0].to(device), data[1].to(device)
-        
-        optimizer.zero_grad()
+        if graph_step != None:
+            if batch.shape != graph_step['static_input'].shape: # Skip the last partial batch.
+                continue
+
+            graph_step['static_input'].copy_(batch, non_blocking=True)
+            graph_step['static_target'].copy_(labels, non_blocking=True)
+            graph_step['graph'].replay()
+
+            pred = graph_step['static_pred']
+            loss = graph_step['static_loss']
+        else:
+            optimizer.zero_grad(set_to_none=True)
 
-        pred = model(batch)
+            with torch.cuda.amp.autocast(enabled=scaler.is_enabled()):
+                pred = model(batch)
+                loss = criterion(pred, labels)
         pred_max = torch.argmax(pred, 1)
 
-        loss = criterion(pred, labels)
-
-        if idx%100 == 0 and cur_epoch % 20 == 0:
-            input_ex = make_grid(batch.detach().cpu(), normalize=True, nrow=8, padding=2).permute([1,2,0])
-            fig, ax = plt.subplots(1,1,figsize=(8,(batch.size(0)//8)+1))
-            ax.imshow(input_ex)
-            ax.set_title(f"Train Batch Examples")
-            ax.axis('off')
-            fig.savefig(os.path.join(save_path, f"Train_BatchSample_E{cur_epoch}_I{idx}.png"))
-            plt.draw()
-            plt.clf()
-            plt.close("all")
+        if save_path != None and idx == 0 and cur_epoch % 20 == 0:
+            save_batch_sample(batch, f"Train Batch Examples", \
+                os.path.join(save_path, f"Train_BatchSample_E{cur_epoch}_I{idx}.png"), figsize=(8,(batch.size(0)//8)+1))
             
-        train_loss += loss.detach().cpu().numpy()
+        train_loss += loss.detach().float()
         train_n_samples += labels.size(0)
-        train_n_corrects += torch.sum(pred_max == labels).detach().cpu().numpy()
+        train_n_corrects += torch.sum(pred_max == labels)
 
-        loss.backward()
-        optimizer.step()
+        if graph_step == None:
+            scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
    
     scheduler.step()
 
-    epoch_train_loss = train_loss / len(train_loader)
-    epoch_train_acc = train_n_corrects/train_n_samples
+    epoch_train_loss = train_loss.item() / len(train_loader)
+    epoch_train_acc = train_n_corrects.item()/train_n_samples
+
+    wait_batch_samples()
 
     return model, epoch_train_loss, epoch_train_acc
 
@@ -249,26 +365,32 @@ def train_CutMix(model, train_loader, optimizer, scheduler, criterion, cur_epoch
 
     save_path = kwargs['save_path']
     cut_prob = kwargs['cut_prob']
+    scaler = kwargs['scaler']
     beta = 1 # In CutMix, they use Uniform(0, 1) distribution where Beta(1, 1).
 
+    # Permutations for every step of the epoch at once. (One row per step)
+    perm_pool = torch.rand(len(train_loader), train_loader.batch_size, device=device).argsort(dim=1)
+
     model.train()
 
-    train_loss = 0
-    train_n_corrects = 0
+    # Accumulated on the device to avoid a host sync on every iteration.
+    train_loss = torch.zeros((), device=device)
+    train_n_corrects = torch.zeros((), device=device, dtype=torch.long)
     train_n_samples = 0
 
-    for idx, data in enumerate(train_loader):
-
-        batch, labels = data[0].to(device), data[1].to(device)
+    for idx, (batch, labels) in enumerate(DataPrefetcher(train_loader, device, torch.channels_last)):
         
-        optimizer.zero_grad()
+        optimizer.zero_grad(set_to_none=True)
 
         r = np.random.rand(1)
 
         if r < cut_prob:
             # generate mixed sample
             lam = np.random.beta(1, 1)
-            rand_index = torch.randperm(batch.size()[0]).cuda()
+            if batch.size()[0] == perm_pool.size(1):
+                rand_index = perm_pool[idx]
+            else:
+                rand_index = torch.randperm(batch.size()[0], device=batch.device)
             labels_a = labels
             labels_b = labels[rand_index]
             
@@ -278,77 +400,68 @@ def train_CutMix(model, train_loader, optimizer, scheduler, criterion, cur_epoch
             lam = 1 - ((bbx2 - bbx1) * (bby2 - bby1) / (batch.size()[-1] * batch.size()[-2]))
             
             # compute output
-            pred = model(batch)
-            loss = criterion(pred, labels_a) * lam + criterion(pred, labels_b) * (1. - lam)
+            with torch.cuda.amp.autocast(enabled=scaler.is_enabled()):
+                pred = model(batch)
+                loss = criterion(pred, labels_a) * lam + criterion(pred, labels_b) * (1. - lam)
         else:
             # compute output
-            pred = model(batch)
-            loss = criterion(pred, labels)
+            with torch.cuda.amp.autocast(enabled=scaler.is_enabled()):
+                pred = model(batch)
+                loss = criterion(pred, labels)
 
         pred_max = torch.argmax(pred, 1)
         
-        if idx%100 == 0 and cur_epoch % 20 == 0:
-            input_ex = make_grid(batch.detach().cpu(), normalize=True, nrow=8, padding=2).permute([1,2,0])
-            fig, ax = plt.subplots(1,1,figsize=(8,(batch.size(0)//8)+1))
-            ax.imshow(input_ex)
-            ax.set_title(f"TrainVal CutMix Batch Examples")
-            ax.axis('off')
-            fig.savefig(os.path.join(save_path, f"TrainVal_BatchSample_E{cur_epoch}_I{idx}.png"))
-            plt.draw()
-            plt.clf()
-            plt.close("all")
-
-        loss.backward()
-        optimizer.step()
+        if save_path != None and idx == 0 and cur_epoch % 20 == 0:
+            save_batch_sample(batch, f"TrainVal CutMix Batch Examples", \
+                os.path.join(save_path, f"TrainVal_BatchSample_E{cur_epoch}_I{idx}.png"), figsize=(8,(batch.size(0)//8)+1))
+
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
             
-        train_loss += loss.detach().cpu().numpy()
+        train_loss += loss.detach().float()
         train_n_samples += labels.size(0)
-        train_n_corrects += torch.sum(pred_max == labels).detach().cpu().numpy()
+        train_n_corrects += torch.sum(pred_max == labels)
     
     scheduler.step()
 
-    epoch_train_loss = train_loss / len(train_loader)
-    epoch_train_acc = train_n_corrects/train_n_samples
+    epoch_train_loss = train_loss.item() / len(train_loader)
+    epoch_train_acc = train_n_corrects.item()/train_n_samples
+
+    wait_batch_samples()
 
     return model, epoch_train_loss, epoch_train_acc
 
 def test(model, test_loader, criterion, device, save_path, cur_epoch):
 
-    test_loss = 0
+    test_loss = torch.zeros((), device=device)
     test_acc = 0
 
     test_n_samples = 0
-    test_n_corrects = 0
+    test_n_corrects = torch.zeros((), device=device, dtype=torch.long)
 
     model.eval()
 
     with torch.no_grad():
-        for idx, data in enumerate(test_loader):
-            batch, labels = data[0].to(device), data[1].to(device)
+        for idx, (batch, labels) in enumerate(DataPrefetcher(test_loader, device, torch.channels_last)):
 
-            pred = model(batch)
+            with torch.cuda.amp.autocast(enabled=(device != 'cpu')):
+                pred = model(batch)
+                loss = criterion(pred, labels)
             pred_max = torch.argmax(pred, 1)
 
-            loss = criterion(pred, labels)
-
-            test_loss += loss.detach().cpu().numpy()
+            test_loss += loss.detach().float() * labels.size(0) # Weighted by the size of the (last) batch.
             test_n_samples += labels.size(0)
-            test_n_corrects += torch.sum(pred_max == labels).detach().cpu().numpy()
+            test_n_corrects += torch.sum(pred_max == labels)
 
             if save_path != None:
-                if idx%300 == 0 and cur_epoch % 20 == 0:
-                    input_ex = make_grid(batch.detach().cpu(), normalize=True, nrow=8, padding=2).permute([1,2,0])
-                    fig, ax = plt.subplots(1,1,figsize=(8,(batch.size(0)//8)+1))
-                    ax.imshow(input_ex)
-                    ax.set_title(f"Testing Batch Examples")
-                    ax.axis('off')
-                
-                    fig.savefig(os.path.join(save_path, f"Test_BatchSample_E{cur_epoch}_I{idx}.png"))
-                    plt.draw()
-                    plt.clf()
-                    plt.close("all")
-
-    test_loss /= len(test_loader)
-    test_acc = test_n_corrects/test_n_samples
+                if idx == 0 and cur_epoch % 20 == 0:
+                    save_batch_sample(batch, f"Testing Batch Examples", \
+                        os.path.join(save_path, f"Test_BatchSample_E{cur_epoch}_I{idx}.png"), figsize=(8,(batch.size(0)//8)+1))
+
+    test_loss = test_loss.item() / test_n_samples
+    test_acc = test_n_corrects.item()/test_n_samples
+
+    wait_batch_samples()
 
     return model, test_loss, test_acc
\ No newline at end of file